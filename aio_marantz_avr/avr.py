@@ -2,8 +2,9 @@
 
 import asyncio
 import telnetlib3
+import time
 
-from typing import Any, List, MutableMapping, Optional, Type
+from typing import AbstractSet, Any, Dict, FrozenSet, List, Optional, Sequence, Tuple, Type
 
 from .enums import InputSource, Power, SurroundMode
 
@@ -26,10 +27,17 @@ class AvrTimeoutError(AvrError):
     pass
 
 
-async def connect(host: str, port: int = 23, timeout: float = 1.0) -> "MarantzAVR":
-    """Connect to an AVR."""
-    reader, writer = await telnetlib3.open_connection(host, port=port, encoding="ascii")
-    return MarantzAVR(reader, writer, timeout)
+async def connect(
+    host: str, port: int = 23, timeout: float = 1.0, pipeline: bool = True
+) -> "MarantzAVR":
+    """Connect to an AVR.
+
+    Arguments:
+    pipeline -- Send all queries of a refresh in a single write. Set to False for AVRs that
+                drop commands sent back to back, to send one query at a time instead.
+    """
+    reader, writer = await telnetlib3.open_connection(host, port=port, encoding=False)
+    return MarantzAVR(reader, writer, timeout, pipeline)
 
 
 def _on_off_from_bool(value: bool) -> str:
@@ -43,13 +51,63 @@ def _on_off_to_bool(value: str) -> bool:
     return value == "ON"
 
 
-class _DataDefinition:
-    query: str
-    data_names: List[str]
-
-    def __init__(self, query: str, data_names: List[str]):
-        self.query = query
-        self.data_names = data_names
+def _encode_command(*parts: str) -> bytes:
+    return ("".join(parts) + "\r").encode("ascii")
+
+
+# Query command and the names of the data it returns.
+_DATA_DEFS: Tuple[Tuple[bytes, Tuple[str, ...]], ...] = (
+    (b"PW?", ("PW",)),
+    (b"MU?", ("MU",)),
+    (b"MV?", ("MV", "MVMAX")),
+    (b"SI?", ("SI",)),
+    (b"MS?", ("MS",)),
+)
+
+_DATA_NAMES: Tuple[str, ...] = tuple(name for _, names in _DATA_DEFS for name in names)
+
+# Position of each data name in MarantzAVR._data.
+_DATA_SLOTS: Dict[str, int] = {name: slot for slot, name in enumerate(_DATA_NAMES)}
+_PW_SLOT = _DATA_SLOTS["PW"]
+_MU_SLOT = _DATA_SLOTS["MU"]
+_MV_SLOT = _DATA_SLOTS["MV"]
+_MVMAX_SLOT = _DATA_SLOTS["MVMAX"]
+_SI_SLOT = _DATA_SLOTS["SI"]
+_MS_SLOT = _DATA_SLOTS["MS"]
+
+# Names of the responses expected for a request.
+_EXPECT_ALL: FrozenSet[str] = frozenset(_DATA_NAMES)
+_EXPECT_PW: FrozenSet[str] = frozenset(("PW",))
+_EXPECT_MU: FrozenSet[str] = frozenset(("MU",))
+_EXPECT_MV: FrozenSet[str] = frozenset(("MV",))
+_EXPECT_SI: FrozenSet[str] = frozenset(("SI",))
+_EXPECT_MS: FrozenSet[str] = frozenset(("MS",))
+
+# Terminated query commands and the names of the responses expected for them.
+_QUERIES: Tuple[Tuple[bytes, FrozenSet[str]], ...] = tuple(
+    (query + b"\r", frozenset(names)) for query, names in _DATA_DEFS
+)
+
+# All queries joined, so refresh() can send them in a single write.
+_REFRESH_QUERY = b"".join(query for query, _ in _QUERIES)
+
+# Fully terminated commands that do not take an argument.
+_POWER_ON_COMMAND = b"PWON\r"
+_POWER_STANDBY_COMMAND = b"PWSTANDBY\r"
+_VOLUME_UP_COMMAND = b"MVUP\r"
+_VOLUME_DOWN_COMMAND = b"MVDOWN\r"
+
+
+def _build_prefix_table(slots: Dict[str, int]) -> Dict[bytes, Tuple[Tuple[bytes, str, int], ...]]:
+    """Group encoded data names, names and slots by 2 byte command prefix, longest name first."""
+    table: Dict[bytes, List[Tuple[bytes, str, int]]] = {}
+    for name, slot in slots.items():
+        encoded_name = name.encode("ascii")
+        table.setdefault(encoded_name[:2], []).append((encoded_name, name, slot))
+    return {
+        prefix: tuple(sorted(entries, key=lambda entry: len(entry[0]), reverse=True))
+        for prefix, entries in table.items()
+    }
 
 
 class MarantzAVR:
@@ -58,94 +116,128 @@ class MarantzAVR:
     Uses `connect` to create a connection to the AVR.
     """
 
-    DATA_DEFS: List[_DataDefinition] = [
-        _DataDefinition("PW?", ["PW"]),
-        _DataDefinition("MU?", ["MU"]),
-        _DataDefinition("MV?", ["MV", "MVMAX"]),
-        _DataDefinition("SI?", ["SI"]),
-        _DataDefinition("MS?", ["MS"]),
-    ]
+    __slots__ = ("_reader", "_writer", "_timeout", "_pipeline", "_data", "_data_time", "_io_lock")
 
-    _reader: telnetlib3.TelnetReader
-    _writer: telnetlib3.TelnetWriter
-    _timeout: float
+    _PREFIX_TABLE: Dict[bytes, Tuple[Tuple[bytes, str, int], ...]] = _build_prefix_table(
+        _DATA_SLOTS
+    )
 
-    _data: MutableMapping[str, Optional[str]]
-    _reading: bool
+    _SOURCE_LIST: Tuple[InputSource, ...] = tuple(InputSource)
+    _SOUND_MODE_LIST: Tuple[SurroundMode, ...] = tuple(SurroundMode)
+
+    _ENUM_LOOKUP: Dict[Type, Dict[str, Any]] = {
+        enum_type: {member.value: member for member in enum_type}
+        for enum_type in (Power, InputSource, SurroundMode)
+    }
 
     def __init__(
-        self, reader: telnetlib3.TelnetReader, writer: telnetlib3.TelnetWriter, timeout: float,
+        self,
+        reader: telnetlib3.TelnetReader,
+        writer: telnetlib3.TelnetWriter,
+        timeout: float,
+        pipeline: bool = True,
     ):
         self._reader = reader
         self._writer = writer
         self._timeout = timeout
+        self._pipeline = pipeline
         self._prepare_data()
-        self._reading = False
+        self._io_lock = asyncio.Lock()
+
+    async def __aenter__(self) -> "MarantzAVR":
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Close the connection to the AVR."""
+        self._writer.close()
 
     def _prepare_data(self) -> None:
-        self._data = {}
-        for data_def in self.DATA_DEFS:
-            for name in data_def.data_names:
-                self._data[name] = None
+        self._data: List[Optional[str]] = [None] * len(_DATA_NAMES)
+        # Monotonic time each value was last received, None if it never was.
+        self._data_time: List[Optional[float]] = [None] * len(_DATA_NAMES)
 
     @property
     def power(self) -> Optional[Power]:
         """Power state of the AVR."""
-        return self._get_enum_data("PW", Power)
+        return self._get_enum_data(_PW_SLOT, Power)
 
     @property
     def is_volume_muted(self) -> Optional[bool]:
         """Boolean if volume is currently muted."""
-        return self._get_boolean_data("MU")
+        return self._get_boolean_data(_MU_SLOT)
 
     @property
     def volume_level(self) -> Optional[float]:
         """Volume level of the AVR zone (00..max_volume_level)."""
-        return self._get_volume_level("MV")
+        return self._get_volume_level(_MV_SLOT)
 
     @property
     def max_volume_level(self) -> Optional[float]:
         """Maximum volume level of the AVR zone."""
-        return self._get_volume_level("MVMAX")
+        return self._get_volume_level(_MVMAX_SLOT)
 
     @property
     def source(self) -> Optional[InputSource]:
         """Name of the current input source."""
-        return self._get_enum_data("SI", InputSource)
+        return self._get_enum_data(_SI_SLOT, InputSource)
 
     @property
-    def source_list(self) -> List[InputSource]:
+    def source_list(self) -> Sequence[InputSource]:
         """List of available input sources."""
-        return list(InputSource)
+        return self._SOURCE_LIST
 
     @property
     def sound_mode(self) -> Optional[SurroundMode]:
         """Name of the current sound mode."""
-        return self._get_enum_data("MS", SurroundMode)
+        return self._get_enum_data(_MS_SLOT, SurroundMode)
 
     @property
-    def sound_mode_list(self) -> List[SurroundMode]:
+    def sound_mode_list(self) -> Sequence[SurroundMode]:
         """List of available sound modes."""
-        return list(SurroundMode)
+        return self._SOUND_MODE_LIST
 
-    async def refresh(self) -> None:
-        """Refresh all properties from the AVR."""
-        if self._reading:
-            return
+    async def refresh(self, max_age: Optional[float] = None) -> None:
+        """Refresh all properties from the AVR.
 
-        for data_def in self.DATA_DEFS:
-            await self._send_command(data_def.query)
-            await self._wait_for_response_with_timeout(*data_def.data_names)
+        Arguments:
+        max_age -- Only query properties that were not received within the last `max_age`
+                   seconds. By default all properties are queried.
+        """
+        async with self._io_lock:
+            if max_age is None:
+                queries: Sequence[Tuple[bytes, FrozenSet[str]]] = _QUERIES
+            else:
+                queries = self._stale_queries(max_age)
+                if not queries:
+                    return
+
+            if not self._pipeline:
+                # Wait for the responses to each query before sending the next one.
+                for query, expected in queries:
+                    await self._send(query)
+                    await self._wait_for_response_with_timeout(expected)
+                return
+
+            if queries is _QUERIES:
+                query, expected = _REFRESH_QUERY, _EXPECT_ALL
+            else:
+                query = b"".join(stale_query for stale_query, _ in queries)
+                expected = frozenset(name for _, names in queries for name in names)
+
+            # Send all queries at once and collect the responses in whatever order they arrive.
+            await self._send(query)
+            await self._wait_for_response_with_timeout(expected)
 
     async def turn_on(self) -> None:
         """Turn the AVR on."""
-        await self._send_command("PW", "ON")
-        await self._wait_for_response_with_timeout("PW")
+        await self._request(_POWER_ON_COMMAND, _EXPECT_PW)
 
     async def turn_off(self) -> None:
         """Turn the AVR off."""
-        await self._send_command("PW", "STANDBY")
-        await self._wait_for_response_with_timeout("PW")
+        await self._request(_POWER_STANDBY_COMMAND, _EXPECT_PW)
 
     async def mute_volume(self, mute: bool) -> None:
         """Mute or unmute the volume.
@@ -153,8 +245,7 @@ class MarantzAVR:
         Arguments:
         mute -- True to mute, False to unmute.
         """
-        await self._send_command("MU", _on_off_from_bool(mute))
-        await self._wait_for_response_with_timeout("MU")
+        await self._request(_encode_command("MU", _on_off_from_bool(mute)), _EXPECT_MU)
 
     async def set_volume_level(self, level: int) -> None:
         """Set the volume level.
@@ -162,107 +253,113 @@ class MarantzAVR:
         Arguments:
         level -- An integer value between 0 and `max_volume_level`.
         """
-        await self._send_command(f"MV{level:02}")
-        await self._wait_for_response_with_timeout("MV")
+        await self._request(_encode_command(f"MV{level:02}"), _EXPECT_MV)
 
     async def volume_level_up(self) -> None:
         """Turn the volume level up one notch."""
-        await self._send_command("MVUP")
-        await self._wait_for_response_with_timeout("MV")
+        await self._request(_VOLUME_UP_COMMAND, _EXPECT_MV)
 
     async def volume_level_down(self) -> None:
         """Turn the volume level down one notch."""
-        await self._send_command("MVDOWN")
-        await self._wait_for_response_with_timeout("MV")
+        await self._request(_VOLUME_DOWN_COMMAND, _EXPECT_MV)
 
     async def select_source(self, source: InputSource) -> None:
         """Select the input source."""
-        await self._send_command("SI", source.value)
-        await self._wait_for_response_with_timeout("SI")
+        await self._request(_encode_command("SI", source.value), _EXPECT_SI)
 
     async def select_sound_mode(self, mode: SurroundMode) -> None:
         """Select the sound mode."""
-        await self._send_command("MS", mode.value)
-        await self._wait_for_response_with_timeout("MS")
+        await self._request(_encode_command("MS", mode.value), _EXPECT_MS)
 
-    async def _send_command(self, *parts: str) -> None:
+    async def _request(self, command: bytes, expected: AbstractSet[str]) -> None:
+        async with self._io_lock:
+            await self._send(command)
+            await self._wait_for_response_with_timeout(expected)
+
+    async def _send(self, data: bytes) -> None:
         if self._reader.at_eof():
             raise DisconnectedError()
 
-        self._writer.write("".join(parts))
-        self._writer.write("\r")
+        self._writer.write(data)
         await self._writer.drain()
 
-    async def _with_timeout(self, coro) -> Optional[Any]:
+    async def _wait_for_response_with_timeout(self, expected: AbstractSet[str]) -> None:
         try:
-            return await asyncio.wait_for(coro, self._timeout)
+            await asyncio.wait_for(self._wait_for_response(expected), self._timeout)
         except asyncio.TimeoutError:
             raise AvrTimeoutError
 
-    async def _wait_for_response_with_timeout(self, *names: str) -> None:
-        await self._with_timeout(self._wait_for_response(*names))
-
-    async def _wait_for_response(self, *names: str) -> None:
-        if self._reading:
-            return
-
-        self._reading = True
+    async def _wait_for_response(self, expected: AbstractSet[str]) -> None:
         try:
-            pending_names = list(names)
+            pending_names = set(expected)
             while True:
-                line = await self._reader.readline()
-                if not line and self._reader.at_eof():
-                    raise DisconnectedError
-
-                match = self._process_response(line)
+                # The AVR terminates responses with a bare CR. Also accept the telnet CR LF and
+                # CR NUL line endings by dropping what follows the CR from the next line.
+                line = await self._reader.readuntil(b"\r")
+                match = self._process_response(line.lstrip(b"\n\x00"))
                 if match in pending_names:
-                    pending_names.remove(match)
-                    if len(pending_names) == 0:
+                    pending_names.discard(match)
+                    if not pending_names:
                         return
-        except ConnectionError:
+        except (asyncio.IncompleteReadError, ConnectionError):
             raise DisconnectedError
-        finally:
-            self._reading = False
-
-    def _process_response(self, response: str) -> Optional[str]:
-        matches = [name for name in self._data.keys() if response.startswith(name)]
 
-        if not matches:
+    def _stale_queries(self, max_age: float) -> List[Tuple[bytes, FrozenSet[str]]]:
+        """Queries and expected names for all data older than `max_age`."""
+        oldest = time.monotonic() - max_age
+        queries = []
+        for query, expected in _QUERIES:
+            for name in expected:
+                data_time = self._data_time[_DATA_SLOTS[name]]
+                if data_time is None or data_time < oldest:
+                    queries.append((query, expected))
+                    break
+        return queries
+
+    def _process_response(self, response: bytes) -> Optional[str]:
+        candidates = self._PREFIX_TABLE.get(response[:2])
+        if candidates is None:
             return None
 
-        if len(matches) > 1:
-            matches.sort(key=len, reverse=True)
-        match = matches[0]
-
-        self._data[match] = response.strip()[len(match) :]
-        return match
+        for encoded_name, name, slot in candidates:
+            if response.startswith(encoded_name):
+                value = response[len(encoded_name) :].rstrip()
+                self._data[slot] = value.decode("ascii", "replace")
+                self._data_time[slot] = time.monotonic()
+                return name
+        return None
 
-    def _get_boolean_data(self, name: str) -> Optional[bool]:
-        value = self._data[name]
+    def _get_boolean_data(self, slot: int) -> Optional[bool]:
+        value = self._data[slot]
         if value is not None:
             return _on_off_to_bool(value)
         return None
 
-    def _get_int_data(self, name: str) -> Optional[int]:
-        value = self._data[name]
+    def _get_int_data(self, slot: int) -> Optional[int]:
+        value = self._data[slot]
         if value is not None:
             return int(value)
         return None
 
-    def _get_enum_data(self, name: str, enum_type: Type) -> Optional[Any]:
-        value = self._data[name]
-        if value is not None:
+    def _get_enum_data(self, slot: int, enum_type: Type) -> Optional[Any]:
+        value = self._data[slot]
+        if value is None:
+            return None
+
+        member = self._ENUM_LOOKUP[enum_type].get(value)
+        if member is None:
+            # Let the enum raise for unknown values.
             return enum_type(value)
-        return None
+        return member
 
-    def _get_volume_level(self, name: str) -> Optional[float]:
-        value = self._data[name]
+    def _get_volume_level(self, slot: int) -> Optional[float]:
+        value = self._data[slot]
         if value is None:
             return None
 
-        # Volume levels are either 2 or 3 characters. The floating point is between 2 and 3.
+        # Volume levels are either 2 or 3 digits. The floating point is between 2 and 3.
         value = value.strip()
-        level = float(value)
+        level = int(value)
         if len(value) == 3:
-            level /= 10.0
-        return level
+            return level / 10.0
+        return float(level)
@@ -14,7 +14,7 @@ requirements = ["telnetlib3==1.0.2", ]
 
 setup_requirements = ['pytest-runner', ]
 
-test_requirements = ['pytest>=3', "pytest-asyncio>=0.10", ]
+test_requirements = ['pytest>=3', "pytest-asyncio>=0.10", "pytest-xdist", ]
 
 setup(
     author="Rob van der Most",
@@ -0,0 +1,187 @@
+"""Shared fixtures for the aio_marantz_avr tests."""
+
+import asyncio
+import pytest
+
+from typing import Awaitable, List, Mapping
+
+from aio_marantz_avr import connect
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None
+
+
+class TestShell:
+    """Server side of a single connection from the AVR client."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.buffer = bytearray()
+
+    async def run_and_respond(self, aw: Awaitable,
+                              response_mapping: Mapping[bytes, List[bytes]]) -> None:
+        await self.run_concurrently(aw, self.expect_and_respond(response_mapping))
+
+    @staticmethod
+    async def run_concurrently(*aws: Awaitable) -> None:
+        """Run the awaitables together, cancelling the others as soon as one fails."""
+        tasks = [asyncio.ensure_future(aw) for aw in aws]
+        try:
+            await asyncio.wait_for(asyncio.gather(*tasks), timeout=5)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def read_more(self) -> bool:
+        """Append the next chunk of received data to the buffer, False on EOF."""
+        data = await self.reader.read(4096)
+        self.buffer += data
+        return bool(data)
+
+    async def read_command(self) -> bytes:
+        """Read the next CR terminated command, reading from the connection in bulk."""
+        while True:
+            end = self.buffer.find(b"\r")
+            if end >= 0:
+                command = bytes(self.buffer[:end + 1])
+                del self.buffer[:end + 1]
+                return command
+
+            if not await self.read_more():
+                return b""
+
+    async def discard_until(self, marker: bytes) -> None:
+        """Drop everything received up to and including the marker."""
+        while True:
+            end = self.buffer.find(marker)
+            if end >= 0:
+                del self.buffer[:end + len(marker)]
+                return
+
+            if not await self.read_more():
+                raise EOFError("Connection closed before the marker was received")
+
+    async def expect_and_respond(self, response_mapping: Mapping[bytes, List[bytes]]) -> None:
+        # Only a handful of commands are expected, so match them in place in the buffer
+        # instead of slicing out and hashing every received command.
+        pending = list(response_mapping.items())
+        while pending:
+            end = self.buffer.find(b"\r")
+            if end < 0:
+                if not await self.read_more():
+                    raise EOFError("Connection closed before all commands were received")
+                continue
+
+            for index, (command, responses) in enumerate(pending):
+                if len(command) == end + 1 and self.buffer.startswith(command):
+                    del pending[index]
+                    self.writer.write(b"".join(responses))
+                    await self.writer.drain()
+                    break
+            del self.buffer[:end + 1]
+
+
+@pytest.fixture(scope="session")
+def event_loop():
+    # Session scoped so the test server can be shared by all tests. Uses uvloop if available.
+    if uvloop is not None:
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+async def accepted_shells():
+    """Shells for the connections accepted by the test server, in order."""
+    return asyncio.Queue()
+
+
+@pytest.fixture(scope="session")
+async def test_server(accepted_shells):
+    def accept(reader, writer):
+        accepted_shells.put_nowait(TestShell(reader, writer))
+
+    # Let the OS pick a free port, once for the whole session.
+    # A plain TCP server is enough; the client does not start any telnet negotiation.
+    server = await asyncio.start_server(accept, host="127.0.0.1", port=0)
+    yield server
+    server.close()
+    await server.wait_closed()
+
+
+@pytest.fixture(scope="session")
+def server_port(test_server):
+    return test_server.sockets[0].getsockname()[1]
+
+
+async def open_connection(server_port, accepted_shells):
+    avr = await connect("127.0.0.1", port=server_port)
+    shell = await asyncio.wait_for(accepted_shells.get(), timeout=5)
+    return avr, shell
+
+
+def close_connection(avr, shell):
+    avr.close()
+    shell.writer.close()
+
+
+def is_idle(avr):
+    """Whether the connection is open and no call is in progress."""
+    return not avr._io_lock.locked() and not avr._reader.at_eof()
+
+
+async def synchronize(avr, shell):
+    """Drop data still in flight in either direction by exchanging a marker."""
+    marker = b"SYNC\r"
+    await avr._send(marker)
+    await shell.discard_until(marker)
+    shell.writer.write(marker)
+    await shell.writer.drain()
+    while (await avr._reader.readuntil(b"\r")).lstrip(b"\n\x00") != marker:
+        pass
+
+
+@pytest.fixture(scope="session")
+async def shared_connection(server_port, accepted_shells):
+    # Connecting is slow, so most tests share a single connection. It is replaced when a
+    # previous test leaves it busy, see the connection fixture.
+    shared = list(await open_connection(server_port, accepted_shells))
+    yield shared
+    close_connection(*shared)
+
+
+@pytest.fixture
+async def connection(shared_connection, server_port, accepted_shells):
+    if not is_idle(shared_connection[0]):
+        close_connection(*shared_connection)
+        shared_connection[:] = await open_connection(server_port, accepted_shells)
+
+    avr, shell = shared_connection
+    await asyncio.wait_for(synchronize(avr, shell), timeout=5)
+    avr._prepare_data()
+    return avr, shell
+
+
+@pytest.fixture
+async def own_connection(server_port, accepted_shells):
+    """A connection of its own, for tests that close it."""
+    avr, shell = await open_connection(server_port, accepted_shells)
+    yield avr, shell
+    close_connection(avr, shell)
+
+
+@pytest.fixture
+def avr(connection):
+    return connection[0]
+
+
+@pytest.fixture
+def test_shell(connection):
+    return connection[1]
@@ -4,83 +4,39 @@
 
 import asyncio
 import pytest
-import telnetlib3
-
-from typing import Awaitable, List, Mapping
 
 from aio_marantz_avr import (connect, DisconnectedError, InputSource, Power, SurroundMode,
                              AvrTimeoutError)
 
 
-class TestShell:
-    reader = None
-    writer = None
-
-    @property
-    def connected(self):
-        return self.reader is not None and self.writer is not None
-
-    def shell(self, reader, writer):
-        self.reader = reader
-        self.writer = writer
-
-    async def run_and_respond(self, aw: Awaitable,
-                              response_mapping: Mapping[str, List[str]]) -> None:
-        await asyncio.wait_for(asyncio.gather(aw, self.expect_and_respond(response_mapping)),
-                               timeout=5)
-
-    async def expect_and_respond(self, response_mapping: Mapping[str, List[str]]) -> None:
-        while True:
-            command = await self.reader.readline()
-
-            if command in response_mapping:
-                responses = response_mapping[command]
-                del response_mapping[command]
-                for response in responses:
-                    self.writer.write(response)
-                    await self.writer.drain()
-                if not response_mapping:
-                    return
-
-
-@pytest.fixture
-def test_shell():
-    return TestShell()
-
-
 def create_task(coro):
     # asyncio.create_task does not exist yet in python 3.6, but ensure_future does the same
     return asyncio.ensure_future(coro)
 
 
-@pytest.fixture
-async def test_server(test_shell, unused_tcp_port):
-    server = await telnetlib3.create_server(shell=test_shell.shell, port=unused_tcp_port,
-                                            encoding="ascii")
-    server_task = create_task(server.wait_closed())
-    yield server
-    test_shell.writer.close()
-    server.close()
-    await server_task
-
-
 @pytest.mark.asyncio
-async def test_connect(test_server, test_shell, unused_tcp_port):
-    avr = await connect("localhost", port=unused_tcp_port)
+async def test_connect(server_port, accepted_shells):
+    avr = await connect("127.0.0.1", port=server_port)
     assert avr is not None
-    assert test_shell.connected
+    shell = await asyncio.wait_for(accepted_shells.get(), timeout=5)
+    avr.close()
+    shell.writer.close()
 
 
-@pytest.fixture
-async def avr(test_server, unused_tcp_port):
-    return await connect("localhost", port=unused_tcp_port)
+@pytest.mark.asyncio
+async def test_close_on_exit(own_connection):
+    avr, test_shell = own_connection
+    async with avr as entered:
+        assert entered is avr
+
+    assert await test_shell.reader.read() == b""
 
 
 @pytest.mark.asyncio
 async def test_mute_on(avr, test_shell):
     await test_shell.run_and_respond(
         avr.mute_volume(True),
-        {"MUON\r": ["MUON\r"]}
+        {b"MUON\r": [b"MUON\r"]}
     )
     assert avr.is_volume_muted is True
 
@@ -89,7 +45,7 @@ async def test_mute_on(avr, test_shell):
 async def test_mute_off(avr, test_shell):
     await test_shell.run_and_respond(
         avr.mute_volume(False),
-        {"MUOFF\r": ["MUOFF\r"]}
+        {b"MUOFF\r": [b"MUOFF\r"]}
     )
     assert avr.is_volume_muted is False
 
@@ -98,7 +54,7 @@ async def test_mute_off(avr, test_shell):
 async def test_turn_on(avr, test_shell):
     await test_shell.run_and_respond(
         avr.turn_on(),
-        {"PWON\r": ["PWON\r"]}
+        {b"PWON\r": [b"PWON\r"]}
     )
     assert avr.power == Power.On
 
@@ -107,7 +63,7 @@ async def test_turn_on(avr, test_shell):
 async def test_turn_off(avr, test_shell):
     await test_shell.run_and_respond(
         avr.turn_off(),
-        {"PWSTANDBY\r": ["PWSTANDBY\r"]}
+        {b"PWSTANDBY\r": [b"PWSTANDBY\r"]}
     )
     assert avr.power == Power.Standby
 
@@ -116,7 +72,7 @@ async def test_turn_off(avr, test_shell):
 async def test_select_source(avr, test_shell):
     await test_shell.run_and_respond(
         avr.select_source(InputSource.DVD),
-        {"SIDVD\r": ["SIDVD\r"]}
+        {b"SIDVD\r": [b"SIDVD\r"]}
     )
     assert avr.source == InputSource.DVD
 
@@ -125,16 +81,25 @@ async def test_select_source(avr, test_shell):
 async def test_select_sound_mode(avr, test_shell):
     await test_shell.run_and_respond(
         avr.select_sound_mode(SurroundMode.Movie),
-        {"MSMOVIE\r": ["MSMOVIE\r"]}
+        {b"MSMOVIE\r": [b"MSMOVIE\r"]}
     )
     assert avr.sound_mode == SurroundMode.Movie
 
 
+@pytest.mark.asyncio
+async def test_trailing_whitespace_stripped(avr, test_shell):
+    await test_shell.run_and_respond(
+        avr.select_sound_mode(SurroundMode.DolbyDigital),
+        {b"MSDOLBY DIGITAL\r": [b"MSDOLBY DIGITAL \r"]}
+    )
+    assert avr.sound_mode == SurroundMode.DolbyDigital
+
+
 @pytest.mark.asyncio
 async def test_set_volume_level(avr, test_shell):
     await test_shell.run_and_respond(
         avr.set_volume_level(30),
-        {"MV30\r": ["MV30\r"]}
+        {b"MV30\r": [b"MV30\r"]}
     )
     assert avr.volume_level == 30.
 
@@ -143,7 +108,7 @@ async def test_set_volume_level(avr, test_shell):
 async def test_set_volume_level_single_digit(avr, test_shell):
     await test_shell.run_and_respond(
         avr.set_volume_level(3),
-        {"MV03\r": ["MV03\r"]}
+        {b"MV03\r": [b"MV03\r"]}
     )
     assert avr.volume_level == 3.
 
@@ -152,7 +117,7 @@ async def test_set_volume_level_single_digit(avr, test_shell):
 async def test_volume_level_up(avr, test_shell):
     await test_shell.run_and_respond(
         avr.volume_level_up(),
-        {"MVUP\r": ["MV30\r"]}
+        {b"MVUP\r": [b"MV30\r"]}
     )
     assert avr.volume_level == 30.
 
@@ -161,7 +126,7 @@ async def test_volume_level_up(avr, test_shell):
 async def test_volume_level_down(avr, test_shell):
     await test_shell.run_and_respond(
         avr.volume_level_down(),
-        {"MVDOWN\r": ["MV30\r"]}
+        {b"MVDOWN\r": [b"MV30\r"]}
     )
     assert avr.volume_level == 30.
 
@@ -170,17 +135,57 @@ async def test_volume_level_down(avr, test_shell):
 async def test_volume_level_decimal(avr, test_shell):
     await test_shell.run_and_respond(
         avr.volume_level_down(),
-        {"MVDOWN\r": ["MV305\r"]}
+        {b"MVDOWN\r": [b"MV305\r"]}
+    )
+    assert avr.volume_level == 30.5
+
+
+@pytest.mark.asyncio
+async def test_max_volume_level_padded(avr, test_shell):
+    await test_shell.run_and_respond(
+        avr.refresh(),
+        {b"MU?\r": [b"MUOFF\r"], b"PW?\r": [b"PWON\r"], b"MV?\r": [b"MV305\r", b"MVMAX 80\r"],
+         b"SI?\r": [b"SISAT/CBL\r"], b"MS?\r": [b"MSDOLBY DIGITAL\r"], }
     )
     assert avr.volume_level == 30.5
+    assert avr.max_volume_level == 80.
+
+
+@pytest.mark.asyncio
+async def test_unknown_response_ignored(avr, test_shell):
+    await test_shell.run_and_respond(
+        avr.volume_level_up(),
+        {b"MVUP\r": [b"ZMON\r", b"MV30\r"]}
+    )
+    assert avr.volume_level == 30.
+
+
+@pytest.mark.asyncio
+async def test_telnet_line_endings(avr, test_shell):
+    await test_shell.run_and_respond(
+        avr.mute_volume(True),
+        {b"MUON\r": [b"PWON\r\n", b"SIDVD\r\x00", b"MUON\r\n"]}
+    )
+    assert avr.power == Power.On
+    assert avr.source == InputSource.DVD
+    assert avr.is_volume_muted is True
+
+
+@pytest.mark.asyncio
+async def test_non_ascii_response(avr, test_shell):
+    await test_shell.run_and_respond(
+        avr.mute_volume(True),
+        {b"MUON\r": [b"MU\xe9\r"]}
+    )
+    assert avr.is_volume_muted is False
 
 
 @pytest.mark.asyncio
 async def test_refresh(avr, test_shell):
     await test_shell.run_and_respond(
         avr.refresh(),
-        {"MU?\r": ["MUOFF\r"], "PW?\r": ["PWON\r"], "MV?\r": ["MV400\r", "MVMAX980\r"],
-         "SI?\r": ["SISAT/CBL\r"], "MS?\r": ["MSDOLBY DIGITAL\r"], }
+        {b"MU?\r": [b"MUOFF\r"], b"PW?\r": [b"PWON\r"], b"MV?\r": [b"MV400\r", b"MVMAX980\r"],
+         b"SI?\r": [b"SISAT/CBL\r"], b"MS?\r": [b"MSDOLBY DIGITAL\r"], }
     )
     assert avr.power == Power.On
     assert avr.is_volume_muted is False
@@ -190,9 +195,51 @@ async def test_refresh(avr, test_shell):
     assert avr.sound_mode == SurroundMode.DolbyDigital
 
 
+@pytest.mark.asyncio
+async def test_refresh_without_pipeline(server_port, accepted_shells):
+    avr = await connect("127.0.0.1", port=server_port, pipeline=False)
+    test_shell = await asyncio.wait_for(accepted_shells.get(), timeout=5)
+
+    async def respond():
+        for command, response in ((b"PW?\r", b"PWON\r"), (b"MU?\r", b"MUOFF\r"),
+                                  (b"MV?\r", b"MV400\rMVMAX980\r"), (b"SI?\r", b"SISAT/CBL\r"),
+                                  (b"MS?\r", b"MSDOLBY DIGITAL\r")):
+            assert await test_shell.read_command() == command
+            # The next query is only sent once this one is answered.
+            assert not test_shell.buffer
+            test_shell.writer.write(response)
+
+    try:
+        await test_shell.run_concurrently(avr.refresh(), respond())
+        assert avr.power == Power.On
+        assert avr.max_volume_level == 98.
+        assert avr.sound_mode == SurroundMode.DolbyDigital
+    finally:
+        avr.close()
+        test_shell.writer.close()
+
+
+@pytest.mark.asyncio
+async def test_refresh_max_age(avr, test_shell):
+    await test_shell.run_and_respond(
+        avr.mute_volume(True),
+        {b"MUON\r": [b"MUON\r"]}
+    )
+    await test_shell.run_and_respond(
+        avr.refresh(max_age=60),
+        {b"PW?\r": [b"PWON\r"], b"MV?\r": [b"MV400\r", b"MVMAX980\r"],
+         b"SI?\r": [b"SISAT/CBL\r"], b"MS?\r": [b"MSDOLBY DIGITAL\r"], }
+    )
+    assert avr.power == Power.On
+    assert avr.is_volume_muted is True
+
+    # Everything is fresh, so nothing is sent to the AVR.
+    await avr.refresh(max_age=60)
+
+
 @pytest.mark.asyncio
 async def test_timeout_during_refresh(avr, test_shell):
-    task = create_task(test_shell.expect_and_respond({"MU?\r": ["MUOFF\r"], }))
+    task = create_task(test_shell.expect_and_respond({b"MU?\r": [b"MUOFF\r"], }))
 
     with pytest.raises(AvrTimeoutError):
         await avr.refresh()
@@ -210,45 +257,55 @@ def test_initial_state(avr):
     assert avr.sound_mode is None
 
 
-@pytest.mark.asyncio
-async def test_refresh_while_running_command(avr, test_shell):
-    turn_on_task = create_task(avr.turn_on())
-    command = await test_shell.reader.readline()
-    assert command == "PWON\r"
+def test_source_and_sound_mode_lists(avr):
+    assert list(avr.source_list) == list(InputSource)
+    assert list(avr.sound_mode_list) == list(SurroundMode)
 
-    await avr.refresh()
 
-    test_shell.writer.write("PWON\r")
-    await test_shell.writer.drain()
-    await turn_on_task
+@pytest.mark.asyncio
+async def test_refresh_while_running_command(avr, test_shell):
+    async def respond():
+        assert await test_shell.read_command() == b"PWON\r"
+        test_shell.writer.write(b"PWON\r")
+        await test_shell.expect_and_respond(
+            {b"MU?\r": [b"MUOFF\r"], b"PW?\r": [b"PWON\r"], b"MV?\r": [b"MV400\r", b"MVMAX980\r"],
+             b"SI?\r": [b"SISAT/CBL\r"], b"MS?\r": [b"MSDOLBY DIGITAL\r"], }
+        )
+
+    await test_shell.run_concurrently(avr.turn_on(), avr.refresh(), respond())
+    assert avr.power == Power.On
 
 
 @pytest.mark.asyncio
 async def test_run_command_while_refreshing(avr, test_shell):
-    refresh_task = create_task(avr.refresh())
-    command = await test_shell.reader.readline()
-    assert command
-
-    await avr.turn_on()
-    command2 = await test_shell.reader.readline()
-    assert command2 == "PWON\r"
-
-    refresh_task.cancel()
+    async def respond():
+        assert await test_shell.read_command() == b"PW?\r"
+        test_shell.writer.write(b"PWOFF\r")
+        await test_shell.expect_and_respond(
+            {b"MU?\r": [b"MUOFF\r"], b"MV?\r": [b"MV400\r", b"MVMAX980\r"],
+             b"SI?\r": [b"SISAT/CBL\r"], b"MS?\r": [b"MSDOLBY DIGITAL\r"], }
+        )
+        # The command is only sent once the refresh is complete.
+        assert await test_shell.read_command() == b"PWON\r"
+        test_shell.writer.write(b"PWON\r")
+
+    await test_shell.run_concurrently(avr.refresh(), avr.turn_on(), respond())
+    assert avr.power == Power.On
 
 
 @pytest.mark.asyncio
-async def test_refresh_after_disconnect(avr, test_shell, test_server):
+async def test_refresh_after_disconnect(own_connection):
+    avr, test_shell = own_connection
     test_shell.writer.close()
-    test_server.close()
 
     with pytest.raises(DisconnectedError):
         await avr.refresh()
 
 
 @pytest.mark.asyncio
-async def test_send_command_after_disconnect(avr, test_shell, test_server):
+async def test_send_command_after_disconnect(own_connection):
+    avr, test_shell = own_connection
     test_shell.writer.close()
-    test_server.close()
 
     with pytest.raises(DisconnectedError):
         await avr.turn_on()